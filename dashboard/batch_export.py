@@ -0,0 +1,187 @@
+# Headless batch export
+# Run the dashboard's select-and-export logic (dashboard_utils.write_file) over many files without the UI.
+# Use-case is to curate hundreds of xarray cubes on a batch node.
+
+# Run from an EASI JupyterLab Terminal or a batch node:
+# 1. `cd` to this directory
+# 2. `python batch_export.py manifest.json --workers 8`
+# 3. Re-run the same command after an interruption. Finished outputs are skipped.
+
+# Manifest (JSON). Top-level keys are defaults that each export entry can override:
+# {
+#     "output_dir": "exports",
+#     "format": "nc",                                  # "nc" or "tif"
+#     "bands": ["ndvi"],                               # Default: all bands
+#     "overwrite": false,
+#     "exports": [
+#         {"file": "a.nc", "times": [0, 3, 7]},                          # Time indices
+#         {"file": "b.nc", "dates": ["2020-04-15T00:12:31"]},            # Exact dates
+#         {"file": "c.nc", "start": "2020-01-01", "end": "2020-06-30",   # Date range
+#          "format": "tif", "output": "c_first_half.tif"}
+#     ]
+# }
+# Without a time filter all time layers are exported. The output defaults to <output_dir>/<file stem>.<format>.
+# "dates" must all match a time layer, to the second (as the dashboard labels) or to the given sub-second precision.
+# "start" and "end" are both inclusive, and "end" includes all of its precision: "2020-06-30" includes every time
+# layer on that day, "2020-06" every time layer in June. See dashboard_utils.TimeIndex.
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import dashboard_utils as app  # All the data manipulation functions are here
+
+
+def read_manifest(manifest: str) -> list:
+    """Return a list of export jobs (dicts) from a manifest file, with the defaults applied"""
+    with open(manifest) as f:
+        config = json.load(f)
+    defaults = {k: v for k, v in config.items() if k != 'exports'}
+    jobs = []
+    for entry in config.get('exports', []):
+        job = dict(defaults, **entry)
+        if 'file' not in job:
+            raise ValueError(f'Export entry has no "file": {entry}')
+        fmt = job.setdefault('format', 'nc').lstrip('.')
+        if fmt not in ('nc', 'tif'):
+            raise ValueError(f'Export format must be "nc" or "tif": {fmt}')
+        if 'output' not in job:
+            output_dir = Path(job.get('output_dir', '.'))
+            job['output'] = str(output_dir / f"{Path(job['file']).stem}.{fmt}")
+        elif Path(job['output']).suffix != f'.{fmt}':
+            raise ValueError(f'Output file name must end with ".{fmt}": {job["output"]}')
+        jobs.append(job)
+    return jobs
+
+
+def select_times(filename: str, job: dict) -> list:
+    """Return the time indices of filename selected by the job's "times", "dates" or "start"/"end" filters"""
+    if 'times' in job:
+        return [int(i) for i in job['times']]
+    time_index = app.xr_time_index(filename)
+    if 'dates' in job:
+        return time_index.exact(job['dates']).tolist()
+    return time_index.range(job.get('start'), job.get('end')).tolist()
+
+
+def part_file_name(output: Path) -> Path:
+    """Temporary file name used while writing an output, so that unfinished files are never mistaken as done"""
+    return output.with_name(output.stem + '.part' + output.suffix)
+
+
+def export_one(job: dict) -> dict:
+    """Export one manifest entry. Returns a result dict with the status and throughput counters"""
+    start = time.perf_counter()
+    result = {'file': job['file'], 'output': job['output'], 'status': 'done', 'slices': 0, 'bytes': 0, 'message': ''}
+    output = Path(job['output'])
+    overwrite = job.get('overwrite', False)
+    parts = []  # Temporary files to remove if the export fails
+    try:
+        if output.suffix == '.nc' and output.exists() and not overwrite:
+            result['status'] = 'skipped'  # Checked before opening the input file, so resuming is cheap
+            return result
+        ds = app.read_user_xarray(job['file'])  # xr.Dataset or Read error string
+        if isinstance(ds, str):
+            raise RuntimeError(ds)
+        bands = job.get('bands') or app.xr_bands(job['file'])
+        selected = select_times(job['file'], job)
+        if len(selected) == 0:
+            raise ValueError('No time layers selected')
+        output.parent.mkdir(parents=True, exist_ok=True)
+        part = part_file_name(output)
+
+        if output.suffix == '.nc':
+            parts = [part]
+            if part.exists():
+                part.unlink()  # Left over from an interrupted run
+            success, msg = app.write_file(job['file'], bands, selected, part, True)
+            if not success:
+                raise RuntimeError(msg)
+            os.replace(part, output)
+            result['bytes'] = output.stat().st_size
+        else:  # COGs, one file per time layer. Resume per time layer
+            timestrs = ds.time.dt.strftime('%Y%m%dT%H%M%S').data
+            todo = [i for i in selected if overwrite or not app.cog_file_name(output, timestrs[i]).exists()]
+            if len(todo) == 0:
+                result['status'] = 'skipped'
+                return result
+            parts = [app.cog_file_name(part, timestrs[i]) for i in todo]
+            success, msg = app.write_file(job['file'], bands, todo, part, True)
+            if not success:
+                raise RuntimeError(msg)
+            for i in todo:
+                target = app.cog_file_name(output, timestrs[i])
+                os.replace(app.cog_file_name(part, timestrs[i]), target)
+                result['bytes'] += target.stat().st_size
+            selected = todo
+        result['slices'] = len(selected)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['message'] = str(e)
+        for path in parts:
+            if path.exists():
+                path.unlink()
+    finally:
+        result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def format_summary(results: list, seconds: float) -> str:
+    """Return a throughput summary for a list of export results"""
+    counts = {status: sum(r['status'] == status for r in results) for status in ('done', 'skipped', 'failed')}
+    slices = sum(r['slices'] for r in results)
+    mbytes = sum(r['bytes'] for r in results) / 1e6
+    lines = [
+        f"Files:       {len(results)} ({counts['done']} done, {counts['skipped']} skipped, {counts['failed']} failed)",
+        f'Time layers: {slices}',
+        f'Written:     {mbytes:.1f} MB',
+        f'Elapsed:     {seconds:.1f} s',
+    ]
+    if seconds > 0:
+        lines.append(f'Throughput:  {counts["done"] / seconds:.2f} files/s, {slices / seconds:.2f} layers/s, {mbytes / seconds:.1f} MB/s')
+    return '\n'.join(lines)
+
+
+def run(jobs: list, workers: int = None) -> list:
+    """Run the export jobs across a process pool, one file per task. Returns the list of results"""
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(export_one, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                r = future.result()
+            except Exception as e:  # E.g. a worker process was killed (out of memory)
+                job = futures[future]
+                r = {'file': job['file'], 'output': job['output'], 'status': 'failed',
+                     'slices': 0, 'bytes': 0, 'seconds': 0.0, 'message': repr(e)}
+            results.append(r)
+            line = f"[{len(results)}/{len(jobs)}] {r['status']:7} {r['file']} -> {r['output']} ({r['seconds']:.1f} s)"
+            if r['message']:
+                line += f": {r['message']}"
+            print(line, flush=True)
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Export selected bands and time layers from many xarray files.')
+    parser.add_argument('manifest', help='JSON manifest of files, bands, time filters and output formats')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--overwrite', action='store_true', help='Re-export outputs that already exist')
+    args = parser.parse_args(argv)
+
+    jobs = read_manifest(args.manifest)
+    if args.overwrite:
+        for job in jobs:
+            job['overwrite'] = True
+    start = time.perf_counter()
+    results = run(jobs, args.workers)
+    print(format_summary(results, time.perf_counter() - start))
+    return 1 if any(r['status'] == 'failed' for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,37 @@
+# Build overview sidecar files
+# Write decimated overview levels (2x, 4x, 8x, ..) of xarray files to zarr sidecar files, so that the dashboard
+# can display large cubes without reading them at full resolution. See dashboard_utils.build_overviews.
+
+# Run from an EASI JupyterLab Terminal or a batch node:
+# 1. `cd` to this directory
+# 2. `python build_overviews.py file1.nc file2.nc --factors 2 4 8 16 --workers 8`
+# 3. Re-run the same command after an interruption. Time layers that are already written are skipped.
+
+import argparse
+import sys
+import time
+
+import dashboard_utils as app  # All the data manipulation functions are here
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Build overview sidecar files for xarray files.')
+    parser.add_argument('files', nargs='+', help='xarray files')
+    parser.add_argument('--factors', type=int, nargs='+', default=[2, 4, 8, 16], help='Overview decimation factors (default: 2 4 8 16)')
+    parser.add_argument('--workers', type=int, default=4, help='Number of time layers written at once (default: 4)')
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for filename in args.files:
+        start = time.perf_counter()
+        try:
+            app.build_overviews(filename, tuple(args.factors), args.workers)
+            print(f'done    {filename} -> {app.overview_file(filename)} ({time.perf_counter() - start:.1f} s)', flush=True)
+        except Exception as e:
+            failed += 1
+            print(f'failed  {filename}: {e}', flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
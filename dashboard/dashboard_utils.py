@@ -1,10 +1,13 @@
 # Support functions for streamlit apps
 
 import matplotlib.pyplot as plt
+import numpy as np
 import xarray as xr
 import io
+import os
 from pathlib import Path
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 from datacube.drivers.netcdf import write_dataset_to_netcdf
 from datacube.utils.cog import write_cog
@@ -43,10 +46,14 @@ def get_logo() -> str:
 
 
 @lru_cache(maxsize=128)  # Only hashable arg types
-def read_user_xarray(filename: str) -> xr.Dataset:
-    """Open the filename with xarray and return the xarray object, or an error string"""
+def read_user_xarray(filename: str, factor: int = 1) -> xr.Dataset:
+    """Open the filename with xarray and return the xarray object, or an error string.
+    If factor > 1 open that overview level from the overview sidecar file (see build_overviews)"""
     try:
-        ds = xr.open_dataset(filename)
+        if factor > 1:
+            ds = xr.open_zarr(overview_file(filename), group=f'level_{factor}').drop_vars('built')
+        else:
+            ds = xr.open_dataset(filename)
     except Exception as e:
         return str(e)
     return ds
@@ -68,6 +75,79 @@ def xr_times(filename: str) -> list:
     ds = read_user_xarray(filename)
     return ds.time.dt.strftime('%Y-%m-%dT%H:%M:%S').data.tolist()
 
+class TimeIndex:
+    """Sorted datetime64 index of a time coordinate for fast date lookups.
+    Lookups use binary search (np.searchsorted) and accept a single date or an array of dates.
+    Returned indices are positions in the original (unsorted) time coordinate"""
+
+    def __init__(self, times):
+        times = np.asarray(times, dtype='datetime64[ns]')
+        self._order = np.argsort(times, kind='stable')
+        self._sorted = times[self._order]
+        self._sorted_labels = self._sorted.astype('datetime64[s]')  # Resolution of the xr_times labels
+
+    def __len__(self) -> int:
+        return len(self._sorted)
+
+    def nearest(self, dates) -> np.ndarray:
+        """Return the indices of the times closest to each of dates"""
+        dates = np.atleast_1d(np.asarray(dates, dtype='datetime64[ns]'))
+        right = np.clip(np.searchsorted(self._sorted, dates), 1, len(self) - 1)
+        left = right - 1
+        pick_left = np.abs(dates - self._sorted[left]) <= np.abs(self._sorted[right] - dates)
+        pos = np.where(pick_left, left, right) if len(self) > 1 else np.zeros(len(dates), dtype=int)
+        return self._order[pos]
+
+    def exact(self, dates) -> np.ndarray:
+        """Return the indices of the times equal to each of dates. Raise KeyError if any are not found.
+        Dates with second (or coarser) resolution, e.g. xr_times labels, match the times truncated to seconds"""
+        dates = np.atleast_1d(np.asarray(dates, dtype='datetime64'))
+        if np.datetime_data(dates.dtype)[0] in ('ms', 'us', 'ns', 'ps', 'fs', 'as'):
+            return self._lookup(self._sorted, dates.astype('datetime64[ns]'))
+        return self._lookup(self._sorted_labels, dates.astype('datetime64[s]'))
+
+    def range(self, start=None, end=None) -> np.ndarray:
+        """Return the indices of the times between start and end (inclusive), in time order.
+        The end includes its whole resolution, e.g. all of the day for a date like '2020-06-30'"""
+        lo = 0 if start is None else np.searchsorted(self._sorted, np.datetime64(start).astype('datetime64[ns]'), side='left')
+        if end is None:
+            hi = len(self)
+        else:
+            end = np.datetime64(end)
+            end = (end + 1).astype('datetime64[ns]') - np.timedelta64(1, 'ns')  # Last ns of the end's resolution
+            hi = np.searchsorted(self._sorted, end, side='right')
+        return self._order[lo:hi]
+
+    def index(self, label: str) -> int:
+        """Return the index of a time label from xr_times"""
+        return int(self.exact(np.datetime64(label, 's'))[0])
+
+    def mask(self, indices=None, start=None, end=None) -> np.ndarray:
+        """Return a boolean selection array for the time indices and/or the start to end range"""
+        mask = np.zeros(len(self), dtype=bool)
+        if indices is not None:
+            mask[np.asarray(indices, dtype=int)] = True
+        if start is not None or end is not None:
+            in_range = np.zeros(len(self), dtype=bool)
+            in_range[self.range(start, end)] = True
+            mask = (mask & in_range) if indices is not None else in_range
+        return mask
+
+    def _lookup(self, sorted_times: np.ndarray, dates: np.ndarray) -> np.ndarray:
+        pos = np.searchsorted(sorted_times, dates)
+        found = pos < len(self)
+        found[found] = sorted_times[pos[found]] == dates[found]
+        if not found.all():
+            raise KeyError(f'Times not found: {dates[~found].astype(str).tolist()}')
+        return self._order[pos]
+
+
+@lru_cache(maxsize=128)  # Only hashable arg types
+def xr_time_index(filename: str) -> TimeIndex:
+    """Return a TimeIndex for the time coordinate of the xarray object"""
+    ds = read_user_xarray(filename)
+    return TimeIndex(ds.time.values)
+
 def xr_bands(filename: str) -> list:
     """Return a list of variable or band lables for the xarray object"""
     ds = read_user_xarray(filename)
@@ -81,40 +161,200 @@ def get_plot_for_timeslice(
     index: str,
     vrng: tuple
 ) -> plt.Figure:
-    """Create a matplotlib figure for the band and time index of the xarray object"""
-    fig, axes = plt.subplots(figsize=(8, 6))
+    """Create a matplotlib figure for the band and time index of the xarray object.
+    Reads from the coarsest overview level that still meets the figure resolution"""
+    figsize, dpi = (8, 6), 100
+    fig, axes = plt.subplots(figsize=figsize)
     ds = read_user_xarray(filename)
+    shape = [ds.sizes[dim] for dim in ds[band].dims if dim != 'time']
+    factor = overview_factor(xr_overview_levels(filename), shape, (figsize[1] * dpi, figsize[0] * dpi))
+    if factor > 1:
+        overview = read_user_xarray(filename, factor)
+        if not isinstance(overview, str):  # Else use the native resolution
+            ds = overview
     timeslice = ds[band].isel(time=index)
     timeslice.plot(vmin=vrng[0], vmax=vrng[1], ax=axes)
     return fig
 
 
+# Overviews
+# Decimated copies (2x, 4x, 8x, ..) of each band and time layer are written to a zarr sidecar file next to the
+# input file, one group per level. get_plot_for_timeslice reads the coarsest level that meets the display
+# resolution, so large cubes are not read at full resolution for small figures.
+
+def overview_file(filename: str) -> Path:
+    """Return the overview sidecar file name for the filename"""
+    return Path(f'{filename}.overviews.zarr')
+
+
+def xr_overview_levels(filename: str) -> tuple:
+    """Return the factors of the fully built, up to date overview levels for the filename"""
+    store = overview_file(filename)
+    if not store.exists():
+        return ()
+    # Cached until the sidecar file (build_overviews touches it when done) or the source file changes
+    stamp = _source_stamp(filename)
+    return _overview_levels(filename, store.stat().st_mtime_ns, tuple(stamp.items()))
+
+
+@lru_cache(maxsize=128)  # Only hashable arg types
+def _overview_levels(filename: str, mtime: int, stamp: tuple) -> tuple:
+    store = overview_file(filename)
+    stamp = dict(stamp)
+    levels = []
+    for group in store.glob('level_*'):
+        built = _built_times(store, group.name, stamp)
+        if built is not None and built.all():
+            levels.append(int(group.name.split('_')[1]))
+    return tuple(sorted(levels))
+
+
+def overview_factor(levels: tuple, shape: list, display: tuple) -> int:
+    """Return the largest of the overview levels for a (y, x) array shape that still has
+    at least the (y, x) display resolution along both axes, or 1 if no level is suitable"""
+    scale = min(shape[0] / display[0], shape[1] / display[1])
+    return max([f for f in levels if f <= scale], default=1)
+
+
+def build_overviews(
+    filename: str,
+    factors: tuple = (2, 4, 8, 16),
+    workers: int = 4,
+    chunk_size: int = 2048
+) -> list:
+    """Build (or resume building) the overview sidecar file for the filename.
+    Each level is decimated from the previous level, in spatial chunks of about chunk_size pixels.
+    Up to workers time layers are written at once and layers already written by an interrupted
+    run are skipped. Levels built from a different version (modified time or size) of the file are rebuilt.
+    Returns the list of overview groups that were built"""
+    ds = read_user_xarray(filename)
+    if isinstance(ds, str):
+        raise RuntimeError(ds)
+    factors = sorted(factors)
+    store = overview_file(filename)
+    stamp = _source_stamp(filename)
+    spatial = [dim for dim in ds.dims if dim != 'time']
+    # Keep masks and classifications as is. Integer bands with a _FillValue are opened as float
+    categorical = {
+        name for name, band in ds.data_vars.items()
+        if not np.issubdtype(band.encoding.get('dtype', band.dtype), np.floating)
+    }
+    # Chunks aligned to the decimation factors, so each level is decimated chunk by chunk
+    chunk_size = max(chunk_size // factors[-1], 1) * factors[-1]
+    chunks = {'time': 1, **{dim: chunk_size for dim in spatial}}
+    native = ds.chunk(chunks)  # Lazy
+    source = native
+    source_factor = 1
+    groups = []
+    for factor in factors:
+        if factor % source_factor != 0:
+            raise ValueError(f'Overview factors must be multiples of each other: {factors}')
+        group = f'level_{factor}'
+        level = _decimate(source, factor // source_factor, native, factor, categorical).chunk(chunks)
+        built = _built_times(store, group, stamp)
+        if built is None or len(built) != level.sizes['time']:
+            template = level.assign(built=('time', np.zeros(level.sizes['time'], dtype=bool)))
+            template.built.attrs.update(stamp)
+            # One chunk per time layer so that the layers can be written in parallel
+            template.to_zarr(store, group=group, mode='w', compute=False, encoding={'built': {'chunks': (1,)}})
+            built = template.built.values
+        # Variables without a time dimension are written with the template
+        layer_vars = [name for name in level.variables if 'time' not in level[name].dims]
+        level = level.drop_vars(layer_vars)
+
+        def write_layer(i):
+            region = {'time': slice(i, i + 1)}
+            # One chunk at a time per layer. The layers are the parallelism
+            level.isel(time=region['time']).to_zarr(
+                store, group=group, region=region, compute=False
+            ).compute(scheduler='synchronous')
+            # Mark done after the data is written
+            xr.Dataset({'built': ('time', [True])}).to_zarr(store, group=group, region=region)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(write_layer, np.flatnonzero(~built)))
+        groups.append(f'{store}/{group}')
+        source = xr.open_zarr(store, group=group).drop_vars('built')
+        source_factor = factor
+    os.utime(store)  # Signal the change to xr_overview_levels
+    return groups
+
+
+def _decimate(source: xr.Dataset, step: int, native: xr.Dataset, factor: int, categorical: set) -> xr.Dataset:
+    """Return the overview level at factor. Averaged bands are reduced from the previous level (source) by step.
+    Categorical bands (e.g. masks and classifications) take the centre pixel of each factor x factor block of
+    the native bands, so that they line up with the block-centre coordinates"""
+    spatial = {dim: step for dim in source.dims if dim != 'time'}
+    coords = {dim: source[dim].coarsen({dim: step}, boundary='trim').mean() for dim in spatial if dim in source.coords}
+    bands = {}
+    for name, band in source.data_vars.items():
+        if name in categorical:
+            band = native[name].isel({
+                dim: slice(factor // 2, (native.sizes[dim] // factor) * factor, factor)
+                for dim in band.dims if dim in spatial
+            })
+        else:
+            band = band.coarsen({dim: step for dim in band.dims if dim in spatial}, boundary='trim').mean()
+        bands[name] = band.drop_vars(list(coords), errors='ignore').assign_attrs(native[name].attrs)
+    level = xr.Dataset(bands, attrs=source.attrs).assign_coords(coords)
+    for variable in level.variables.values():
+        variable.encoding = {}  # Source (e.g. netCDF) encodings do not apply to zarr
+    return level
+
+
+def _source_stamp(filename: str) -> dict:
+    """Return the modified time and size of the filename, to check that overviews are up to date"""
+    stat = Path(filename).stat()
+    return {'source_mtime_ns': stat.st_mtime_ns, 'source_size': stat.st_size}
+
+
+def _built_times(store: Path, group: str, stamp: dict) -> np.ndarray:
+    """Return the per-time-layer built flags of an overview level, or None if it does not exist
+    or was built from a different version of the source file"""
+    if not (store / group).exists():
+        return None
+    built = xr.open_zarr(store, group=group)['built']
+    if any(built.attrs.get(key) != value for key, value in stamp.items()):
+        return None
+    return built.values
+
+
+def cog_file_name(write_file: str, timestr: str) -> Path:
+    """Return the per-timeslice COG file name for a ".tif" target and a '%Y%m%dT%H%M%S' time label"""
+    write_file = Path(write_file)
+    return write_file.with_name(write_file.stem + f'-{timestr}.tif')
+
+
 def write_file(
     filename: str,
-    band: str,
+    band,
     selected: list,
     write_file: str,
     overwrite: bool
 ) -> tuple:
-    """Write the selected band and time indices to netCDF or COG files.
+    """Write the selected band(s) and time indices to netCDF or COG files.
+    Band can be a band name or a list of band names.
     Returns (success, message) tuple"""
     write_file = Path(write_file)
     if write_file.suffix not in ('.tif', '.nc'):
         return False, f'Choose a target file name ending with ".tif" or ".nc": {write_file.suffix}'
+    bands = [band] if isinstance(band, str) else list(band)
     ds = read_user_xarray(filename)
+    if isinstance(ds, str):
+        return False, ds
     try:
         if write_file.suffix == '.nc':
             if write_file.exists() and not overwrite:
                 return False, 'File exists'
-            ds_slice = ds[[band]].isel(time=selected)
+            ds_slice = ds[bands].isel(time=selected)
             write_dataset_to_netcdf(ds_slice, write_file)
             msg = str(write_file)
         else: # COGs
             msg = []
             for i in selected:
-                singletimestamp_da = ds.isel(time=i).to_array()
+                singletimestamp_da = ds[bands].isel(time=i).to_array()
                 timestr = str(ds.time[i].dt.strftime('%Y%m%dT%H%M%S').data)
-                target = write_file.stem + f'-{timestr}.tif'
+                target = str(cog_file_name(write_file, timestr))
                 msg.append(target)
                 write_cog(
                     geo_im = singletimestamp_da,
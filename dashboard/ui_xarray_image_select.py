@@ -136,7 +136,7 @@ if is_state() and is_valid() and not do_grid():
         'Choose a timeslice',
         options = st.session_state['times'],
     )
-    view_index = st.session_state['times'].index(view_time)
+    view_index = app.xr_time_index(st.session_state['input_file']).index(view_time)
 
     # Image
     st.write(
@@ -8,12 +8,19 @@
 
 import numpy as np
 import math
+import json
+import warnings
+from functools import partial
 import folium
-from pyproj import Transformer
+from pyproj import CRS, Transformer
 import geopandas as gpd
+import shapely
 import xarray as xr
+import dask.array as dsa
 import rasterio.features
+from datacube.utils import masking
 from datacube.utils.cog import write_cog
+from datacube.utils.geometry import assign_crs
 
 
 # Borrowed from https://github.com/GeoscienceAustralia/dea-notebooks/blob/develop/Tools/dea_tools/datahandling.py
@@ -156,10 +163,12 @@ def xr_vectorize(da,
                  crs=None, 
                  dtype='float32',
                  export_shp=False,
+                 output='geodataframe',
                  verbose=False,
                  **rasterio_kwargs):    
     """
-    Vectorises a xarray.DataArray into a geopandas.GeoDataFrame.
+    Vectorises a xarray.DataArray into a geopandas.GeoDataFrame, or
+    into columnar (ragged array) geometry buffers.
     
     Parameters
     ----------
@@ -186,8 +195,15 @@ def xr_vectorize(da,
          or float32
     export_shp : Boolean or string path, optional
         To export the output vectorised features to a shapefile, supply
-        an output path (e.g. 'output_dir/output.shp'. The default is 
+        an output path (e.g. 'output_dir/output.shp'. A path ending 
+        with '.parquet' is written as GeoParquet. The default is 
         False, which will not write out a shapefile. 
+    output : str, optional
+        'geodataframe' (default) or 'ragged'. 'ragged' returns the 
+        polygons as columnar buffers without creating shapely 
+        geometries or a GeoDataFrame, see Returns. (rasterio still 
+        yields one GeoJSON-like dict per polygon.) These can be passed
+        to `xr_rasterize` or to `shapely.from_ragged_array`.
     verbose : bool, optional
         Print debugging messages. Default False.
     **rasterio_kwargs : 
@@ -196,7 +212,10 @@ def xr_vectorize(da,
     
     Returns
     -------
-    gdf : Geopandas GeoDataFrame
+    gdf : Geopandas GeoDataFrame, or if output='ragged' a tuple of
+        (geometry_type, coords, offsets, values, crs), where the first 
+        three are as in `shapely.to_ragged_array`, values is a numpy 
+        array of the raster value of each polygon and crs is a string.
     
     """
 
@@ -244,21 +263,42 @@ def xr_vectorize(da,
     # Convert the generator into a list
     vectors = list(vectors)
     
-    # Extract the polygon coordinates and values from the list
-    polygons = [polygon for polygon, value in vectors]
-    values = [value for polygon, value in vectors]
+    # Extract the polygon coordinates and values from the list into
+    # columnar (ragged array) buffers: all ring coordinates in one array, 
+    # with offsets to the start of each ring and each polygon
+    rings = [ring for polygon, value in vectors for ring in polygon['coordinates']]
+    values = np.array([value for polygon, value in vectors], dtype=dtype)
+    if rings:
+        coords = np.concatenate([np.asarray(ring, dtype='float64') for ring in rings])
+    else:
+        coords = np.empty((0, 2), dtype='float64')
+    ring_offsets = np.cumsum([0] + [len(ring) for ring in rings])
+    polygon_offsets = np.cumsum([0] + [len(polygon['coordinates']) for polygon, value in vectors])
+    ragged = (shapely.GeometryType.POLYGON, coords, (ring_offsets, polygon_offsets))
+    
+    if verbose:
+        print(f'Vectorised {len(values)} polygons with {len(coords)} vertices')
     
-    # Convert polygon coordinates into polygon shapes
-    polygons = [shape(polygon) for polygon in polygons]
+    if output == 'ragged' and not export_shp:
+        return ragged + (values, str(crs))
+    
+    # Create the polygon shapes in one vectorised call
+    polygons = shapely.from_ragged_array(*ragged)
     
     # Create a geopandas dataframe populated with the polygon shapes
     gdf = gpd.GeoDataFrame(data={attribute_col: values},
                            geometry=polygons,
                            crs=str(crs))
     
-    # If a file path is supplied, export a shapefile
+    # If a file path is supplied, export a shapefile or GeoParquet file
     if export_shp:
-        gdf.to_file(export_shp) 
+        if str(export_shp).endswith('.parquet'):
+            gdf.to_parquet(export_shp)
+        else:
+            gdf.to_file(export_shp) 
+    
+    if output == 'ragged':
+        return ragged + (values, str(crs))
         
     return gdf
 
@@ -279,9 +319,16 @@ def xr_rasterize(gdf,
     
     Parameters
     ----------
-    gdf : geopandas.GeoDataFrame
+    gdf : geopandas.GeoDataFrame, str or tuple
         A geopandas.GeoDataFrame object containing the vector/shapefile
-        data you want to rasterise.
+        data you want to rasterise. Can also be the path to a 
+        GeoParquet file, of which only the geometry and 
+        `attribute_col` columns are read (through a memory map, then 
+        decoded into a GeoDataFrame), or a tuple of ragged array 
+        buffers (geometry_type, coords, offsets, values, crs) as 
+        returned by `xr_vectorize(..., output='ragged')`. Ragged array
+        coordinates are reprojected as one array if their crs differs
+        from the raster CRS.
     da : xarray.DataArray or xarray.Dataset
         The shape, coordinates, dimensions, and transform of this object 
         are used to build the rasterized shapefile. It effectively 
@@ -290,7 +337,8 @@ def xr_rasterize(gdf,
     attribute_col : string, optional
         Name of the attribute column in the geodataframe that the pixels 
         in the raster will contain.  If set to False, output will be a 
-        boolean array of 1's and 0's.
+        boolean array of 1's and 0's. For ragged array input any true 
+        value uses the ragged array values.
     crs : str, optional
         CRS metadata to add to the output xarray. e.g. 'epsg:3577'.
         The function will attempt get this info from the input 
@@ -377,21 +425,37 @@ def xr_rasterize(gdf,
     if verbose:
         print(f'Rasterizing to match xarray.DataArray dimensions ({y}, {x})')
     
-    try:
-        gdf_reproj = gdf.to_crs(crs=crs)
-    except:
-        # Sometimes the crs can be a datacube utils CRS object
-        # so convert to string before reprojecting
-        gdf_reproj = gdf.to_crs(crs=str(crs))
+    if isinstance(gdf, tuple):
+        # Ragged arrays. Reproject all the coordinates at once if needed
+        geometry_type, coords, offsets, values, ragged_crs = gdf
+        if CRS.from_user_input(ragged_crs) != CRS.from_user_input(str(crs)):
+            transformer = Transformer.from_crs(ragged_crs, str(crs), always_xy=True)
+            coords = np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+        geometries = shapely.from_ragged_array(geometry_type, coords, offsets)
+    else:
+        if not isinstance(gdf, gpd.GeoDataFrame):
+            # GeoParquet file
+            import pyarrow.parquet as pq
+            geo = json.loads(pq.read_schema(gdf).metadata[b'geo'])
+            columns = [geo['primary_column']] + ([attribute_col] if attribute_col else [])
+            gdf = gpd.read_parquet(gdf, columns=columns, memory_map=True)
+        try:
+            gdf_reproj = gdf.to_crs(crs=crs)
+        except:
+            # Sometimes the crs can be a datacube utils CRS object
+            # so convert to string before reprojecting
+            gdf_reproj = gdf.to_crs(crs=str(crs))
+        geometries = gdf_reproj.geometry.to_numpy()
+        values = gdf_reproj[attribute_col].to_numpy() if attribute_col else None
     
     # If an attribute column is specified, rasterise using vector 
     # attribute values. Otherwise, rasterise into a boolean array
     if attribute_col:        
-        # Use the geometry and attributes from `gdf` to create an iterable
-        shapes = zip(gdf_reproj.geometry, gdf_reproj[attribute_col])
+        # Use the geometry and attribute arrays to create an iterable
+        shapes = zip(geometries, values)
     else:
         # Use geometry directly (will produce a boolean numpy array)
-        shapes = gdf_reproj.geometry
+        shapes = geometries
 
     # Rasterise shapes into an array
     arr = rasterio.features.rasterize(shapes=shapes,
@@ -417,4 +481,247 @@ def xr_rasterize(gdf,
                   export_tiff,
                   overwrite=True)
                 
-    return xarr
\ No newline at end of file
+    return xarr
+
+
+# Reducers that can be computed from per-chunk partial results, and how the partials are combined
+_PARTIAL_REDUCERS = {
+    'mean': ('sum', 'count'),
+    'sum': ('sum',),
+    'count': ('count',),
+    'min': ('min',),
+    'max': ('max',),
+}
+
+
+def masked_composite(ds,
+                     expressions,
+                     mask=None,
+                     mask_band='mask',
+                     reducer='median',
+                     dtype='float32',
+                     max_chunk_mb=256,
+                     time_batch=None,
+                     split_every=None,
+                     scratch=None):
+    """
+    Mask, calculate band expressions and reduce over time in a single
+    fused step per dask chunk.
+
+    This replaces the usual sequence of `masking.make_mask`, `.where`,
+    index calculation and `.median(dim='time')` (or mean etc.), each of
+    which adds a full-size intermediate to the dask graph. Here each chunk
+    is read once and only the reduced result (or, for the mean, sum,
+    count, min and max reducers, one partial result per batch of time
+    steps, see `time_batch`) is kept.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        Dataset with a time dimension, e.g. from `dc.load(...,
+        dask_chunks={'time': 1, 'x': 500, 'y': 500})`. Numpy-backed
+        datasets are also accepted.
+    expressions : dict or list
+        Output variables. A dict of name: expression, where expression is
+        a string evaluated with the band names and `np` available (e.g.
+        `{'NDVI': '(nir_1 - red) / (nir_1 + red)'}`) or a function that
+        takes a dict of band name: numpy array and returns an array.
+        A list of band names outputs those bands unchanged.
+    mask : dict or list of dicts, optional
+        Flag values passed to `masking.make_mask` for the `mask_band`,
+        e.g. `{'qa': 'vegetation'}`. A list of dicts keeps pixels that
+        match any of them (logical OR), as in the notebooks. Default None
+        (no masking).
+    mask_band : str, optional
+        Name of the mask band. Defaults to 'mask'.
+    reducer : str or function, optional
+        One of 'median', 'mean', 'sum', 'count', 'min', 'max', or a
+        function called as `reducer(values, axis=0)` on each chunk, with
+        masked pixels set to NaN. Defaults to 'median'.
+    dtype : str, optional
+        Data type of the calculations and outputs. Defaults to 'float32'.
+    max_chunk_mb : float, optional
+        Approximate maximum size of the input chunks (all bands) read by
+        each task. For the 'median' and function reducers all time steps
+        of a chunk are needed at once, so the spatial chunk size is
+        reduced to fit. For the other reducers it sets the default
+        `time_batch`, and the spatial chunks are reduced if one time
+        batch does not fit. Defaults to 256.
+    time_batch : int, optional
+        For the other reducers, the number of time steps processed per
+        chunk. Each chunk produces one partial result per expression 
+        (two for 'mean'), so larger batches give a smaller graph and 
+        fewer partials, smaller batches use less memory. Defaults to as
+        many time steps as fit in `max_chunk_mb`.
+    split_every : int, optional
+        Number of partial results combined at a time in the tree
+        reduction over time. See `dask.array.reduction`.
+    scratch : str, optional
+        For the other reducers and very long time ranges, a zarr path
+        (e.g. on fast local disk) to write the per-batch partial results
+        to. The partials are computed and written when this function is
+        called, and the returned result is reduced from the zarr store,
+        so they are not held in worker memory. Default None (partials 
+        stay in the dask graph).
+
+    Returns
+    -------
+    xarray.Dataset with one (dask-backed) variable per expression and
+    the spatial coordinates of `ds`.
+    """
+
+    if not isinstance(expressions, dict):
+        expressions = {name: name for name in expressions}
+    if isinstance(mask, dict):
+        mask = [mask]
+
+    # Bands needed by the expressions
+    if any(callable(expr) for expr in expressions.values()):
+        bands = [name for name in ds.data_vars if name != mask_band]
+    else:
+        names = set()
+        for expr in expressions.values():
+            names.update(compile(expr, '<expression>', 'eval').co_names)
+        bands = [name for name in ds.data_vars if name in names and name != mask_band]
+
+    if not callable(reducer) and reducer != 'median' and reducer not in _PARTIAL_REDUCERS:
+        raise ValueError(f"reducer must be a function, 'median' or one of {list(_PARTIAL_REDUCERS)}: {reducer}")
+
+    # (mask, value) bits for each flag rule, as in masking.make_mask
+    rules = None
+    if mask:
+        flags_def = ds[mask_band].attrs['flags_definition']
+        rules = [masking.create_mask_value(flags_def, **flags) for flags in mask]
+
+    names = bands + ([mask_band] if rules else [])
+    sub = ds[names].transpose('time', ...)
+    if not sub.chunks:
+        sub = sub.chunk()
+    sub = sub.unify_chunks()
+    spatial_dims = sub[names[0]].dims[1:]
+
+    use_partials = not callable(reducer) and reducer in _PARTIAL_REDUCERS
+    if use_partials:
+        bytes_per_pixel_step = sum(sub[name].dtype.itemsize + np.dtype(dtype).itemsize for name in names)
+        pixels = np.prod([max(sub.chunks[dim]) for dim in spatial_dims])
+        if not time_batch:
+            # As many time steps as fit in max_chunk_mb for the current spatial chunks
+            time_batch = max(int(max_chunk_mb * 1e6 / (pixels * bytes_per_pixel_step)), 1)
+        time_batch = min(time_batch, sub.sizes['time'])
+        sub = sub.chunk({'time': time_batch})
+        if pixels * time_batch * bytes_per_pixel_step > max_chunk_mb * 1e6:
+            # Too large even for the time batch. Shrink the spatial chunks
+            side = max(int(math.sqrt(max_chunk_mb * 1e6 / (time_batch * bytes_per_pixel_step))), 1)
+            sub = sub.chunk({dim: side for dim in spatial_dims})
+    else:
+        # Whole time series per chunk. Bound the chunk size by shrinking the spatial chunks
+        bytes_per_pixel = sub.sizes['time'] * sum(sub[name].dtype.itemsize + np.dtype(dtype).itemsize for name in names)
+        side = max(int(math.sqrt(max_chunk_mb * 1e6 / bytes_per_pixel)), 1)
+        sub = sub.chunk({'time': -1, **{dim: side for dim in spatial_dims}})
+
+    arrays = [sub[name].data for name in names]
+    nodata = {name: sub[name].attrs.get('nodata') for name in bands}
+    stats = _PARTIAL_REDUCERS[reducer] if use_partials else (reducer,)
+    nout = len(expressions) * len(stats)
+
+    partials = dsa.map_blocks(
+        _composite_kernel,
+        *arrays,
+        bands=bands,
+        expressions=expressions,
+        rules=rules,
+        nodata=nodata,
+        stats=stats,
+        out_dtype=dtype,
+        dtype=dtype,
+        new_axis=0,
+        chunks=((nout,), (1,) * len(arrays[0].chunks[0])) + arrays[0].chunks[1:],
+        meta=np.array((), dtype=dtype),
+    )
+
+    # Spill the partial results to disk and reduce from there
+    if use_partials and scratch:
+        partials.to_zarr(scratch, overwrite=True)
+        partials = dsa.from_zarr(scratch)
+
+    # Combine the per-chunk partial results over time (a tree reduction)
+    if not use_partials:
+        combined = {stats[0]: partials[:, 0]}
+    else:
+        combined = {}
+        for i, stat in enumerate(stats):
+            rows = partials[i::len(stats)]
+            if stat in ('sum', 'count'):
+                combined[stat] = rows.sum(axis=1, split_every=split_every)
+            else:
+                reduce = partial(_quiet_nanreduce, func=np.nanmin if stat == 'min' else np.nanmax)
+                combined[stat] = dsa.reduction(rows, reduce, reduce, axis=1, dtype=dtype,
+                                               split_every=split_every, meta=np.array((), dtype=dtype))
+
+    if reducer == 'mean':
+        result = dsa.map_blocks(_quiet_mean, combined['sum'], combined['count'], dtype=dtype)
+    else:
+        result = combined[stats[0]]
+
+    coords = {name: coord for name, coord in ds.coords.items() if 'time' not in coord.dims}
+    return xr.Dataset(
+        {name: (spatial_dims, result[i]) for i, name in enumerate(expressions)},
+        coords=coords,
+        attrs=ds.attrs,
+    )
+
+
+def _quiet_nanreduce(x, axis=None, keepdims=False, func=np.nanmin, **kwargs):
+    """Helper function for masked_composite(). NaN reduction without All-NaN slice warnings"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return func(x, axis=axis, keepdims=keepdims)
+
+
+def _quiet_mean(total, count):
+    """Helper function for masked_composite(). Mean from partial sums, NaN where there are no values"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return total / count
+
+
+def _composite_kernel(*blocks, bands, expressions, rules, nodata, stats, out_dtype):
+    """Helper function for masked_composite(). Mask, calculate and reduce one chunk"""
+    data = {}
+    for name, block in zip(bands, blocks):
+        values = block.astype(out_dtype)
+        if nodata[name] is not None:
+            values[block == nodata[name]] = np.nan
+        data[name] = values
+
+    keep = None
+    if rules:
+        flags = blocks[-1]
+        keep = np.zeros(flags.shape, dtype=bool)
+        for bits, value in rules:
+            keep |= (flags & bits) == value
+
+    out = []
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)  # All-NaN slices
+        for expr in expressions.values():
+            if callable(expr):
+                values = expr(data)
+            else:
+                values = eval(expr, {'__builtins__': {}, 'np': np}, data)
+            values = np.asarray(values, dtype=out_dtype)
+            if keep is not None:
+                values = np.where(keep, values, np.nan)
+            for stat in stats:
+                if stat == 'sum':
+                    out.append(np.nansum(values, axis=0))
+                elif stat == 'count':
+                    out.append(np.count_nonzero(~np.isnan(values), axis=0).astype(out_dtype))
+                elif stat == 'min':
+                    out.append(np.nanmin(values, axis=0))
+                elif stat == 'max':
+                    out.append(np.nanmax(values, axis=0))
+                elif stat == 'median':
+                    out.append(np.nanmedian(values, axis=0))
+                else:
+                    out.append(np.asarray(stat(values, axis=0), dtype=out_dtype))
+    return np.stack(out)[:, np.newaxis]